@@ -14,6 +14,7 @@ Original file is located at
 
 import os
 import json
+import contextlib
 import torch
 from google.colab import files, drive
 from huggingface_hub import notebook_login
@@ -66,6 +67,8 @@ bnb_config = BitsAndBytesConfig(
 )
 
 # Training Arguments
+# Batch size / accumulation below were hand-tuned for a T4. On other GPUs run
+# `python lora_memory_planner.py plan --gpu <name>` for settings that fit.
 training_args = TrainingArguments(
     output_dir="./gemma2-finetuned-results",  # Directory to save checkpoints and logs
     num_train_epochs=1,                     # Number of training epochs (adjust as needed)
@@ -215,17 +218,32 @@ tokenizer.save_pretrained(adapter_output_dir)
 
 print("\n--- Testing Inference with the Fine-tuned Adapter ---")
 
+# Optional latency profiling (load times here, per-prompt timings in section 12).
+# Needs inference_profiler.py next to this script (upload it to Colab too);
+# without it the inference test below runs as before, just unprofiled.
+try:
+    from inference_profiler import InferenceProfiler, PROBE_PROMPTS
+    profiler = InferenceProfiler(out_path=os.path.join(training_args.output_dir, "inference_profile.jsonl"))
+except ImportError:
+    print("inference_profiler.py not found - skipping latency profiling.")
+    profiler = None
+
+def time_load(name):
+    return profiler.time_load(name) if profiler is not None else contextlib.nullcontext()
+
 # Load the base model again (quantized) - ensure enough VRAM or restart runtime
 print("Reloading base model for inference...")
-base_model_for_inference = AutoModelForCausalLM.from_pretrained(
-    model_id,
-    quantization_config=bnb_config,
-    device_map="cuda"
-)
+with time_load(model_id):
+    base_model_for_inference = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        quantization_config=bnb_config,
+        device_map="cuda"
+    )
 
 print("Loading PEFT adapter...")
 # Load the PEFT model by merging the adapter into the base model
-model_inf = PeftModel.from_pretrained(base_model_for_inference, adapter_output_dir)
+with time_load(adapter_output_dir):
+    model_inf = PeftModel.from_pretrained(base_model_for_inference, adapter_output_dir)
 # Note: For generation, merging might be beneficial, or use the adapter directly.
 # If using PeftModel directly without merging: model_inf = PeftModel.from_pretrained(base_model_for_inference, adapter_output_dir)
 # If merging: model_inf = model_inf.merge_and_unload() # Merges adapter and unloads PEFT, requires more memory
@@ -682,4 +700,23 @@ result = pipe(prompt)
 print("\nGenerated Text:")
 print(result[0]['generated_text'])
 
-print("\n--- Inference Test Complete ---")
\ No newline at end of file
+# --- 12. (Optional) Profile Inference Latency ---
+# Times chat-template rendering, tokenization, prefill and every decode step
+# for each probe prompt and appends one JSON record per prompt (TTFT,
+# inter-token latency percentiles, tokens/s, peak memory) to
+# inference_profile.jsonl. Set trace_dir on the profiler to also export a
+# torch profiler trace per prompt (slower; use for digging, not for numbers).
+# For regression checks without a GPU: python inference_profiler.py bench
+
+if profiler is not None:
+    print("\nProfiling inference latency over the probe prompts...")
+    for i, probe in enumerate(PROBE_PROMPTS):
+        messages = [{"role": "user", "content": probe}]
+        text, record = profiler.profile_generate(model_inf, tokenizer_inf, messages, f"probe-{i:02d}", max_new_tokens=100)
+        print(f"{record['probe_id']}: TTFT {record['ttft_ms']:.0f} ms, "
+              f"ITL p50 {record['itl_p50_ms'] or 0:.1f} ms, {record['tokens_per_s']:.1f} tokens/s, "
+              f"peak {record['peak_memory_bytes'] / 2**30:.2f} GiB")
+
+    print(f"Latency records written to: {profiler.out_path}")
+
+print("\n--- Inference Test Complete ---")
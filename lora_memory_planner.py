@@ -0,0 +1,793 @@
+# -*- coding: utf-8 -*-
+"""Analytic memory and throughput planner for LoRA/QLoRA fine-tuning.
+
+Estimates the training memory footprint (weights, LoRA parameters and
+gradients, optimizer state, activations, logits) for a model config,
+LoraConfig, quantization setting, optimizer and the sequence-length
+histogram of the training data, and recommends the largest micro-batch,
+packing length and gradient-checkpointing setting that fit a memory budget.
+
+By default it reads the settings of the run in this repository:
+base_model_config.json (the Gemma-2-9B-it config, so no Hub access is
+needed), adapter_config.json (LoRA), training_args.bin (batch size,
+accumulation, optimizer, max length) and rwtrainingdata.json (sequence
+lengths), with the 4-bit NF4 quantization used in gemma2biastuned.py:
+
+    python lora_memory_planner.py plan --gpu t4
+    python lora_memory_planner.py plan --budget-gb 22 --model ./gemma-2-9b-it/config.json
+
+The `validate` command compares the estimates with measured peaks for small
+randomly initialised models on CPU, in fp32 and bf16 autocast with eager
+and sdpa attention (Linux only):
+
+    python lora_memory_planner.py validate
+
+bitsandbytes 4-bit layers and 8-bit/paged optimizers need CUDA and cannot
+be measured there; `plan` warns when an estimate depends on them.
+
+Decoder layers are found generically, but the activation estimate follows
+the Llama/Gemma layer layout (rotary attention, gated MLP, nn.Linear
+projections) and has only been validated for those architectures.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import re
+import resource
+import sys
+from dataclasses import dataclass, field
+
+import torch
+from peft import LoraConfig
+from transformers import AutoConfig, AutoModelForCausalLM
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GiB = 2 ** 30
+
+# Device memory as reported by torch.cuda (GiB; the CUDA context comes out of
+# this and is budgeted with --overhead-gb) and nominal dense fp16/bf16 tensor
+# throughput (TFLOPS)
+GPU_PRESETS = {
+    "t4": (14.7, 65),
+    "l4": (22.0, 121),
+    "a10g": (22.0, 70),
+    "a100-40gb": (39.4, 312),
+    "a100-80gb": (79.1, 312),
+    "h100-80gb": (79.1, 989),
+}
+
+# Optimizer state bytes per trainable parameter. bitsandbytes 8-bit optimizers
+# keep tensors smaller than BNB_MIN_8BIT_SIZE elements in 32-bit.
+OPTIMIZER_STATE_BYTES = {
+    "adamw_torch": 8,
+    "adamw_torch_fused": 8,
+    "adamw_hf": 8,
+    "paged_adamw_32bit": 8,
+    "adamw_bnb_8bit": 2,
+    "adamw_8bit": 2,
+    "paged_adamw_8bit": 2,
+    "sgd": 0,
+}
+BNB_MIN_8BIT_SIZE = 4096
+
+# Bytes per parameter of a bitsandbytes 4-bit weight: packed 4-bit values plus
+# one fp32 absmax per 64-value block, or with double quantization an 8-bit
+# absmax per block and one fp32 constant per 256 blocks.
+BNB_4BIT_BYTES = 0.5 + 4 / 64
+BNB_4BIT_DOUBLE_QUANT_BYTES = 0.5 + 1 / 64 + 4 / (64 * 256)
+
+DTYPE_BYTES = {"float32": 4, "bfloat16": 2, "float16": 2}
+
+# Safety margin on activations and logits. `validate` underestimates measured
+# peaks by up to 8% before the margin is applied; plan against the margin
+# rather than the raw estimate so a "fits" verdict errs on the safe side.
+DYNAMIC_MEMORY_MARGIN = 0.10
+
+PACKING_LENGTHS = [256, 512, 1024, 2048, 4096, 8192]
+MAX_MICRO_BATCH = 64
+
+
+@dataclass
+class ModelShape:
+    """What the estimates need to know about the model architecture."""
+
+    layers: int
+    hidden: int
+    intermediate: int
+    heads: int
+    q_dim: int
+    vocab: int
+    norms_per_layer: int
+    attn_softcapping: bool
+    logit_softcapping: bool
+    linear_params: int          # nn.Linear weights inside decoder layers (quantized in 4-bit)
+    other_params: int           # embeddings, norms, untied lm_head
+    lora_tensors: list = field(default_factory=list)   # element counts of LoRA A/B tensors
+    lora_inputs: list = field(default_factory=list)    # per layer: (in_features, r) of each targeted linear
+
+    @property
+    def lora_params(self):
+        return sum(self.lora_tensors)
+
+    @property
+    def total_params(self):
+        return self.linear_params + self.other_params
+
+
+@dataclass
+class MemoryEstimate:
+    weights: float
+    lora: float
+    gradients: float
+    optimizer: float
+    activations: float
+    logits: float
+    margin: float
+    overhead: float
+
+    @property
+    def total(self):
+        return (self.weights + self.lora + self.gradients + self.optimizer
+                + self.activations + self.logits + self.margin + self.overhead)
+
+    def as_gib(self):
+        parts = {name: value / GiB for name, value in vars(self).items()}
+        parts["total"] = self.total / GiB
+        return parts
+
+
+def _matches(patterns, name):
+    """peft's module matching: regex full match for a string, suffix match for a list."""
+    if isinstance(patterns, str):
+        return re.fullmatch(patterns, name) is not None
+    return any(name == t or name.endswith("." + t) for t in patterns)
+
+
+def _is_lora_target(name, layer_index, lora_config):
+    """Whether peft would put a LoRA adapter on the nn.Linear called `name`."""
+    if lora_config.exclude_modules and _matches(lora_config.exclude_modules, name):
+        return False
+    layers = lora_config.layers_to_transform
+    if layers is not None and layer_index not in ([layers] if isinstance(layers, int) else layers):
+        return False
+    return lora_config.target_modules == "all-linear" or _matches(lora_config.target_modules, name)
+
+
+def _lora_rank(name, lora_config):
+    """Rank for `name`, honouring rank_pattern the way peft's get_pattern_key does."""
+    for key, rank in (lora_config.rank_pattern or {}).items():
+        if re.match(rf"(.*\.)?({key})$", name):
+            return rank
+    return lora_config.r
+
+
+# LoraConfig options the estimates do not model. alpha_pattern only changes
+# the scaling of the update, not memory, so it is accepted.
+UNSUPPORTED_LORA_OPTIONS = ["layer_replication", "trainable_token_indices", "layers_pattern"]
+
+
+def load_model_config(model):
+    """AutoConfig from a Hub id, a model directory or a config.json path.
+
+    Raises SystemExit with a pointer to --model when the config cannot be
+    loaded (e.g. a gated Hub model without network access or a token).
+    """
+    try:
+        return _load_model_config(model)
+    except (OSError, ValueError, KeyError) as e:
+        raise SystemExit(f"Could not load the model config for {model!r}: {e}\n"
+                         f"Pass --model path/to/config.json (a local copy of the model's config.json).")
+
+
+def _load_model_config(model):
+    if model.endswith(".json"):
+        with open(model) as f:
+            config_dict = json.load(f)
+        return AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+    return AutoConfig.from_pretrained(model)
+
+
+def _decoder_layers(model, config):
+    """Qualified name and ModuleList of the decoder layers.
+
+    `model.layers` on Llama/Gemma, `transformer.h` on GPT-2/Falcon, and so on:
+    the ModuleList with one entry per hidden layer.
+    """
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == config.num_hidden_layers:
+            return name, module
+    raise ValueError(f"Could not find the list of {config.num_hidden_layers} decoder layers "
+                     f"in {type(model).__name__}")
+
+
+def model_shape(config, lora_config):
+    """Build the model on the meta device and read off parameter counts."""
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+
+    prefix, layers = _decoder_layers(model, config)
+    if not any(isinstance(m, torch.nn.Linear) for m in layers[0].modules()):
+        raise ValueError(f"{type(layers[0]).__name__} has no nn.Linear projections (e.g. GPT-2's Conv1D); "
+                         f"only decoder layers built from nn.Linear are supported")
+    unsupported = [o for o in UNSUPPORTED_LORA_OPTIONS if getattr(lora_config, o, None)]
+    if unsupported:
+        raise ValueError(f"LoraConfig option(s) {', '.join(unsupported)} are not modelled by the planner")
+    linear_params = 0
+    lora_tensors = []
+    lora_inputs = []
+    for i, layer in enumerate(layers):
+        inputs = []
+        for name, module in layer.named_modules():
+            if not isinstance(module, torch.nn.Linear):
+                continue
+            linear_params += module.weight.numel()
+            full_name = f"{prefix}.{i}.{name}"
+            if _is_lora_target(full_name, i, lora_config):
+                r = _lora_rank(full_name, lora_config)
+                lora_tensors += [r * module.in_features, r * module.out_features]
+                if lora_config.use_dora:
+                    lora_tensors.append(module.out_features)
+                inputs.append((module.in_features, r))
+        lora_inputs.append(inputs)
+    if not any(lora_inputs):
+        raise ValueError(f"target_modules {lora_config.target_modules!r} matches no nn.Linear in the "
+                         f"decoder layers of {type(model).__name__}; peft would refuse this config")
+
+    first = layers[0]
+    norms = sum(1 for m in first.modules() if "Norm" in type(m).__name__)
+    linears = [m for m in first.modules() if isinstance(m, torch.nn.Linear)]
+    heads = config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+
+    # peft wraps every module whose name ends with an entry of modules_to_save
+    # (a plain string suffix) and makes a trainable copy of its parameters.
+    # Submodules of a wrapped module are part of that copy, and tied weights
+    # are copied once per wrapping module.
+    saved = []
+    for name, module in model.named_modules(remove_duplicate=False):
+        if any(name.startswith(s + ".") for s in saved):
+            continue
+        if any(name.endswith(m) for m in lora_config.modules_to_save or []):
+            saved.append(name)
+            lora_tensors += [p.numel() for p in module.parameters()]
+    missing = [m for m in lora_config.modules_to_save or [] if not any(s.endswith(m) for s in saved)]
+    if missing:
+        raise ValueError(f"modules_to_save {missing} matches no module of {type(model).__name__}")
+
+    return ModelShape(
+        layers=len(layers),
+        hidden=config.hidden_size,
+        intermediate=getattr(config, "intermediate_size", None) or max(m.out_features for m in linears),
+        heads=heads,
+        q_dim=heads * head_dim,
+        vocab=config.vocab_size,
+        norms_per_layer=norms,
+        attn_softcapping=bool(getattr(config, "attn_logit_softcapping", None)),
+        logit_softcapping=bool(getattr(config, "final_logit_softcapping", None)),
+        linear_params=linear_params,
+        other_params=sum(p.numel() for p in model.parameters()) - linear_params,
+        lora_tensors=lora_tensors,
+        lora_inputs=lora_inputs,
+    )
+
+
+def _layer_activation_bytes(shape, lora_config, lora_inputs, seq_len, compute_bytes, attn_implementation,
+                            quantized):
+    """Bytes saved for backward by one decoder layer with adapters on `lora_inputs`, per token."""
+    c = compute_bytes
+    upcast = 4 if c < 4 else 0   # extra fp32 copy when computing in half precision
+    h, inter = shape.hidden, shape.intermediate
+    # RMSNorm keeps its input and the fp32 normalised output
+    total = shape.norms_per_layer * (c + 4) * h
+    # Rotary-embedded queries and keys and the values; repeat_kv expands keys
+    # and values to the full query width before the attention matmuls
+    total += c * 3 * shape.q_dim
+    if attn_implementation == "eager":
+        # fp32 softmax output, its cast back to the compute dtype and the
+        # tanh output when attention logits are softcapped
+        total += shape.heads * seq_len * (4 + (c if upcast else 0) + (c if shape.attn_softcapping else 0))
+    else:
+        # Fused kernels keep their output (and a small logsumexp) for backward
+        total += c * shape.q_dim
+    # MLP: gate and up outputs, activation output and their product
+    total += c * 4 * inter
+    if quantized:
+        # bitsandbytes 4-bit matmuls keep their input for backward
+        total += c * (2 * h + shape.q_dim)
+    # Each LoRA layer keeps its dropout output, dropout mask and A output
+    mask = 1 if lora_config.lora_dropout > 0 else 0
+    total += sum((c + mask) * d + c * r for d, r in lora_inputs)
+    return total
+
+
+def estimate_memory(shape, lora_config, micro_batch, seq_len, gradient_checkpointing=False,
+                    load_in_4bit=True, double_quant=False, weights_dtype="float32",
+                    compute_dtype="bfloat16", optim="paged_adamw_8bit",
+                    attn_implementation="sdpa", overhead_gb=0.0, margin=DYNAMIC_MEMORY_MARGIN):
+    """Peak training memory for one micro-batch of `micro_batch` x `seq_len` tokens.
+
+    `margin` is added on top of activations and logits as a fraction of them.
+    """
+    c = DTYPE_BYTES[compute_dtype]
+    w = DTYPE_BYTES[weights_dtype]
+    tokens = micro_batch * seq_len
+
+    if load_in_4bit:
+        per_param = BNB_4BIT_DOUBLE_QUANT_BYTES if double_quant else BNB_4BIT_BYTES
+        weights = shape.linear_params * per_param + shape.other_params * w
+    else:
+        weights = shape.total_params * w
+
+    # LoRA parameters and their gradients are kept in fp32
+    lora = 4 * shape.lora_params
+    gradients = 4 * shape.lora_params
+
+    state_bytes = OPTIMIZER_STATE_BYTES[optim]
+    if state_bytes == 2:
+        optimizer = sum(2 * n if n >= BNB_MIN_8BIT_SIZE else 8 * n for n in shape.lora_tensors)
+    else:
+        optimizer = state_bytes * shape.lora_params
+
+    # lm_head output, its fp32 upcast for the loss, the tanh output when the
+    # final logits are softcapped, log-softmax and the gradient of the logits
+    upcast = 4 if c < 4 else 0
+    logits = tokens * shape.vocab * (c + upcast + (4 if shape.logit_softcapping else 0) + 4 + 4)
+
+    per_layer = [tokens * _layer_activation_bytes(shape, lora_config, inputs, seq_len, c, attn_implementation,
+                                                  load_in_4bit)
+                 for inputs in shape.lora_inputs]
+    layer = max(per_layer)
+    if gradient_checkpointing:
+        # Only layer inputs are kept. Layers are recomputed one at a time in
+        # backward, after the logits have been freed, so the recomputed layer
+        # only adds to the peak where it is larger than the logits.
+        activations = tokens * shape.layers * c * shape.hidden + max(layer - logits, 0)
+    else:
+        activations = sum(per_layer)
+    # Embedding output and the final norm
+    activations += tokens * (c + c + 4) * shape.hidden
+
+    return MemoryEstimate(
+        weights=weights,
+        lora=lora,
+        gradients=gradients,
+        optimizer=optimizer,
+        activations=activations,
+        logits=logits,
+        margin=margin * (activations + logits),
+        overhead=overhead_gb * GiB,
+    )
+
+
+def estimate_tokens_per_second(shape, seq_len, gradient_checkpointing, tflops, mfu):
+    """Training throughput from FLOPs per token at a given model FLOPs utilisation.
+
+    Frozen weights only need the forward pass and the input-gradient half of
+    the backward pass (4N FLOPs per token instead of 6N); gradient
+    checkpointing repeats the forward pass.
+    """
+    n = shape.total_params
+    passes = 6 if gradient_checkpointing else 4
+    attention = 2 * 2 * shape.layers * seq_len * shape.q_dim  # QK^T and AV, forward only
+    flops_per_token = passes * n + (passes // 2) * attention
+    return tflops * 1e12 * mfu / flops_per_token
+
+
+# --- Dataset sequence lengths ---
+
+def sequence_lengths(dataset_path, tokenizer_path=None, chars_per_token=4.0, local_files_only=False):
+    """Token count of every `text` in the dataset, plus whether they are exact.
+
+    Uses the model tokenizer when it can be loaded (only from local files and
+    the Hub cache when `local_files_only`); otherwise falls back to a
+    characters-per-token approximation. Two tokens are added for <bos>/<eos>.
+    """
+    with open(dataset_path) as f:
+        try:
+            records = json.load(f)
+        except json.JSONDecodeError:
+            f.seek(0)
+            records = [json.loads(line) for line in f if line.strip()]
+    texts = [r["text"] for r in records]
+
+    if tokenizer_path:
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=local_files_only)
+            return [len(ids) + 2 for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]], True
+        except (OSError, ValueError) as e:
+            print(f"Could not load tokenizer {tokenizer_path!r} ({str(e).splitlines()[0]}); "
+                  f"approximating with {chars_per_token} characters per token.")
+    return [math.ceil(len(t) / chars_per_token) + 2 for t in texts], False
+
+
+def length_histogram(lengths):
+    """Counts per power-of-two bucket: {upper_bound: count}."""
+    buckets = {}
+    for n in lengths:
+        bound = 2 ** max(5, math.ceil(math.log2(max(n, 1))))
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return dict(sorted(buckets.items()))
+
+
+# --- Planning ---
+
+def largest_fitting(candidates, fits):
+    """Largest candidate for which `fits` holds, assuming it is monotone."""
+    best = None
+    for value in candidates:
+        if not fits(value):
+            break
+        best = value
+    return best
+
+
+def plan(shape, lora_config, lengths, budget_bytes, max_length, effective_batch, tflops, mfu, **memory_kwargs):
+    """Recommend micro-batch, packing length and gradient checkpointing for a budget."""
+    longest = min(max(lengths), max_length)
+    mean = sum(min(n, max_length) for n in lengths) / len(lengths)
+    batch_sizes = range(1, MAX_MICRO_BATCH + 1)
+    packing_lengths = [n for n in PACKING_LENGTHS if n <= max_length]
+
+    def fits(batch, seq, gc):
+        return estimate_memory(shape, lora_config, batch, seq, gc, **memory_kwargs).total <= budget_bytes
+
+    options = {}
+    for gc in (False, True):
+        options[gc] = {
+            "micro_batch": largest_fitting(batch_sizes, lambda b: fits(b, longest, gc)),
+            "packing_length": largest_fitting(packing_lengths, lambda n: fits(1, n, gc)),
+            "tokens_per_s": estimate_tokens_per_second(shape, longest, gc, tflops, mfu),
+        }
+
+    # Checkpointing costs an extra forward pass, so only turn it on when the
+    # longest sequence does not fit otherwise or it at least doubles the batch.
+    no_gc, gc = options[False], options[True]
+    use_gc = no_gc["micro_batch"] is None or (
+        gc["micro_batch"] is not None and gc["micro_batch"] >= 2 * no_gc["micro_batch"]
+        and no_gc["micro_batch"] < effective_batch)
+    chosen = options[use_gc]
+    if chosen["micro_batch"] is None:
+        return {"fits": False, "longest_sequence": longest, "options": options}
+
+    # Keep the effective batch size unchanged: largest divisor that fits
+    micro_batch = max(b for b in range(1, min(chosen["micro_batch"], effective_batch) + 1)
+                      if effective_batch % b == 0)
+    packing_length = largest_fitting(packing_lengths, lambda n: fits(micro_batch, n, use_gc))
+    return {
+        "fits": True,
+        "longest_sequence": longest,
+        "mean_sequence": mean,
+        "gradient_checkpointing": use_gc,
+        "micro_batch": micro_batch,
+        "gradient_accumulation_steps": effective_batch // micro_batch,
+        "packing_length": packing_length,
+        # Packing pays off when several examples fit in one packed row
+        "packing_recommended": packing_length is not None and mean * 2 <= packing_length,
+        "tokens_per_s": chosen["tokens_per_s"],
+        "options": options,
+    }
+
+
+def load_training_args(path):
+    """The pickled TrainingArguments/SFTConfig saved next to the adapter (needs trl)."""
+    return torch.load(path, weights_only=False)
+
+
+def _print_estimate(title, estimate, budget_bytes):
+    print(f"\n{title}")
+    for name, value in estimate.as_gib().items():
+        print(f"  {name:<12} {value:8.2f} GiB")
+    verdict = "fits" if estimate.total <= budget_bytes else "DOES NOT FIT"
+    print(f"  -> {verdict} in {budget_bytes / GiB:.1f} GiB")
+
+
+def run_plan(args):
+    lora_config = LoraConfig.from_pretrained(args.adapter_dir)
+    model = args.model
+    if model is None:
+        local_config = os.path.join(REPO_DIR, "base_model_config.json")
+        model = local_config if os.path.exists(local_config) else lora_config.base_model_name_or_path
+    config = load_model_config(model)
+    try:
+        shape = model_shape(config, lora_config)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    training_args = load_training_args(args.training_args) if args.training_args else None
+    micro_batch = args.micro_batch or getattr(training_args, "per_device_train_batch_size", 1)
+    grad_accum = args.grad_accum or getattr(training_args, "gradient_accumulation_steps", 1)
+    optim = args.optim or getattr(training_args, "optim", "paged_adamw_8bit")
+    optim = getattr(optim, "value", optim)  # OptimizerNames enum in saved TrainingArguments
+    max_length = args.max_length or getattr(training_args, "max_length", None) or getattr(training_args, "max_seq_length", 1024)
+    gradient_checkpointing = bool(getattr(training_args, "gradient_checkpointing", False))
+    if optim not in OPTIMIZER_STATE_BYTES:
+        raise SystemExit(f"No optimizer state size known for {optim!r}; "
+                         f"pass --optim with one of: {', '.join(sorted(OPTIMIZER_STATE_BYTES))}")
+    compute_dtype = args.compute_dtype or ("bfloat16" if getattr(training_args, "bf16", True) else "float16")
+
+    if args.gpu:
+        budget_gb, tflops = GPU_PRESETS[args.gpu]
+    else:
+        budget_gb, tflops = args.budget_gb, args.tflops
+    budget_bytes = budget_gb * GiB
+
+    # Without an explicit --tokenizer, only use the base model's tokenizer if
+    # it is already in the local Hub cache
+    lengths, exact = sequence_lengths(args.dataset, args.tokenizer or lora_config.base_model_name_or_path,
+                                      args.chars_per_token, local_files_only=args.tokenizer is None)
+    memory_kwargs = {
+        "load_in_4bit": not args.no_4bit,
+        "double_quant": args.double_quant,
+        "weights_dtype": args.weights_dtype or ("float32" if not args.no_4bit else "bfloat16"),
+        "compute_dtype": compute_dtype,
+        "optim": optim,
+        "attn_implementation": args.attn_implementation,
+        "overhead_gb": args.overhead_gb,
+        "margin": args.margin,
+    }
+
+    print(f"Model: {model} ({shape.total_params / 1e9:.2f}B parameters, "
+          f"{shape.lora_params / 1e6:.1f}M LoRA parameters at r={lora_config.r})")
+    print(f"Optimizer: {optim}, compute dtype: {compute_dtype}, "
+          f"4-bit: {memory_kwargs['load_in_4bit']}, attention: {args.attn_implementation}")
+    print(f"Safety margin: {args.margin:.0%} of activations and logits (see `validate`)")
+    settings = dict(memory_kwargs, model_type=config.model_type)
+    unvalidated = [f"{key}={settings[key]}" for key, values in VALIDATED_SETTINGS.items()
+                   if settings[key] not in values]
+    if unvalidated:
+        print(f"WARNING: unvalidated path ({', '.join(unvalidated)}). `validate` only measures "
+              f"what runs on CPU, so these terms are extrapolated; check the first steps with "
+              f"torch.cuda.max_memory_allocated() before relying on a tight verdict.")
+    print(f"\nSequence lengths ({'tokenizer' if exact else 'approximate'}, {len(lengths)} examples): "
+          f"mean {sum(lengths) / len(lengths):.0f}, max {max(lengths)}, truncated at {max_length}")
+    for bound, count in length_histogram(lengths).items():
+        print(f"  <= {bound:>6}: {count}")
+    if not exact:
+        print("  (pass --tokenizer for exact lengths; the approximation can be off by 15% or more)")
+
+    longest = min(max(lengths), max_length)
+    current = estimate_memory(shape, lora_config, micro_batch, longest, gradient_checkpointing, **memory_kwargs)
+    _print_estimate(f"Current settings: micro-batch {micro_batch} x {longest} tokens, "
+                    f"gradient checkpointing {'on' if gradient_checkpointing else 'off'}",
+                    current, budget_bytes)
+
+    result = plan(shape, lora_config, lengths, budget_bytes, max_length,
+                  micro_batch * grad_accum, tflops, args.mfu, **memory_kwargs)
+    print(f"\nOptions for {budget_gb:.1f} GiB:")
+    for gc, option in result["options"].items():
+        print(f"  gradient checkpointing {'on ' if gc else 'off'}: "
+              f"micro-batch {option['micro_batch'] or '-'} at {longest} tokens, "
+              f"packing length {option['packing_length'] or '-'} at micro-batch 1, "
+              f"~{option['tokens_per_s']:.0f} tokens/s at {args.mfu:.0%} MFU")
+
+    if not result["fits"]:
+        print("\nNothing fits: even one sequence of the longest length is over budget. "
+              "Lower max_length or use a larger GPU.")
+        return 1
+
+    print("\nRecommended:")
+    print(f"  per_device_train_batch_size = {result['micro_batch']}")
+    print(f"  gradient_accumulation_steps = {result['gradient_accumulation_steps']}"
+          f"  (effective batch {micro_batch * grad_accum})")
+    print(f"  gradient_checkpointing = {result['gradient_checkpointing']}")
+    if result["packing_recommended"]:
+        print(f"  packing = True, max_length = {result['packing_length']}")
+    else:
+        print(f"  packing = False (if enabled, keep max_length <= {result['packing_length']})")
+    best = estimate_memory(shape, lora_config, result["micro_batch"], longest,
+                           result["gradient_checkpointing"], **memory_kwargs)
+    _print_estimate("Estimated peak for the recommendation:", best, budget_bytes)
+    return 0
+
+
+# --- Validation against measured peaks on CPU ---
+
+VALIDATION_MODELS = {
+    "gemma2-small": dict(model_type="gemma2", vocab_size=8192, hidden_size=256, intermediate_size=1024,
+                         num_hidden_layers=4, num_attention_heads=4, num_key_value_heads=2, head_dim=64),
+    "llama-small": dict(model_type="llama", vocab_size=8192, hidden_size=256, intermediate_size=688,
+                        num_hidden_layers=4, num_attention_heads=8, num_key_value_heads=8),
+}
+
+VALIDATION_RUNS = [
+    # (model, micro_batch, seq_len, gradient_checkpointing, attention, compute dtype)
+    ("gemma2-small", 2, 256, False, "eager", "float32"),
+    ("gemma2-small", 4, 512, False, "eager", "float32"),
+    ("gemma2-small", 4, 512, True, "eager", "float32"),
+    ("gemma2-small", 4, 512, False, "sdpa", "float32"),
+    ("gemma2-small", 4, 512, False, "eager", "bfloat16"),
+    ("llama-small", 8, 256, False, "eager", "float32"),
+    ("llama-small", 2, 1024, False, "eager", "float32"),
+    ("llama-small", 8, 512, True, "eager", "float32"),
+    ("llama-small", 8, 256, False, "sdpa", "float32"),
+    ("llama-small", 8, 256, False, "eager", "bfloat16"),
+    ("llama-small", 8, 256, False, "sdpa", "bfloat16"),
+    ("llama-small", 8, 512, True, "sdpa", "bfloat16"),
+]
+
+# What `validate` can measure on CPU. bitsandbytes 4-bit layers and 8-bit or
+# paged optimizers need CUDA, so estimates using them are extrapolated.
+VALIDATED_SETTINGS = {
+    "load_in_4bit": {False},
+    "optim": {"adamw_torch", "adamw_torch_fused", "adamw_hf"},
+    "attn_implementation": {"eager", "sdpa"},
+    "compute_dtype": {"float32", "bfloat16"},
+    "model_type": {config["model_type"] for config in VALIDATION_MODELS.values()} | {"gemma"},
+}
+MEASURE_TIMEOUT = 600
+
+
+def _current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_step(config_dict, lora_dict, micro_batch, seq_len, gradient_checkpointing, attention, compute_dtype,
+                  queue):
+    """Run in a fresh process: peak RSS growth over one LoRA training step.
+
+    bfloat16 keeps fp32 weights and autocasts the forward pass, as the
+    Trainer does with bf16=True.
+    """
+    from peft import get_peft_model
+
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    config_dict = dict(config_dict)
+    config = AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+    config._attn_implementation = attention
+    config.use_cache = False
+    model = AutoModelForCausalLM.from_config(config)
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        model.enable_input_require_grads()
+    model = get_peft_model(model, LoraConfig(**lora_dict))
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    input_ids = torch.randint(0, config.vocab_size, (micro_batch, seq_len))
+
+    autocast = torch.autocast("cpu", dtype=torch.bfloat16, enabled=compute_dtype == "bfloat16")
+
+    before = _current_rss()
+    with autocast:
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+    loss.backward()
+    optimizer.step()
+    queue.put(max(_max_rss() - before, 0))
+
+
+def run_validate(args):
+    if not sys.platform.startswith("linux"):
+        raise SystemExit("validate reads RSS from /proc and relies on glibc's malloc settings; run it on Linux")
+    lora_config = LoraConfig.from_pretrained(args.adapter_dir)
+    lora_dict = {
+        "r": lora_config.r,
+        "lora_alpha": lora_config.lora_alpha,
+        "lora_dropout": lora_config.lora_dropout,
+        "target_modules": (lora_config.target_modules if isinstance(lora_config.target_modules, str)
+                           else sorted(lora_config.target_modules)),
+        "task_type": "CAUSAL_LM",
+    }
+    # Options model_shape accounts for, so the measured adapter matches the estimated one
+    for key in ["rank_pattern", "exclude_modules", "layers_to_transform", "modules_to_save", "use_dora"]:
+        if getattr(lora_config, key, None):
+            value = getattr(lora_config, key)
+            lora_dict[key] = sorted(value) if isinstance(value, set) else value
+    # With glibc's adaptive mmap threshold freed tensors stay in the heap and
+    # RSS overstates what is alive; a fixed threshold makes every tensor an
+    # mmap that is returned on free. Spawned children inherit the setting.
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", "65536")
+    context = multiprocessing.get_context("spawn")
+    failures = 0
+
+    print(f"{'model':<14} {'batch':>5} {'seq':>5} {'gc':>3} {'attn':>6} {'dtype':>8} "
+          f"{'estimated':>10} {'measured':>10} {'error':>7} {'+margin':>8}")
+    errors = []
+    for name, micro_batch, seq_len, gc, attention, compute_dtype in VALIDATION_RUNS:
+        config_dict = VALIDATION_MODELS[name]
+        config = dict(config_dict)
+        config = AutoConfig.for_model(config.pop("model_type"), **config)
+        try:
+            shape = model_shape(config, lora_config)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        estimate = estimate_memory(shape, lora_config, micro_batch, seq_len, gc,
+                                   load_in_4bit=False, weights_dtype="float32", compute_dtype=compute_dtype,
+                                   optim="adamw_torch", attn_implementation=attention)
+        # Weights exist before the step starts, so they are not part of the measured growth
+        with_margin = estimate.total - estimate.weights - estimate.lora
+        estimated = with_margin - estimate.margin
+
+        row = (f"{name:<14} {micro_batch:>5} {seq_len:>5} {'on' if gc else 'off':>3} {attention:>6} "
+               f"{compute_dtype.replace('loat', ''):>8}")
+        queue = context.Queue()
+        process = context.Process(target=_measure_step,
+                                  args=(config_dict, lora_dict, micro_batch, seq_len, gc, attention,
+                                        compute_dtype, queue))
+        process.start()
+        # The result is tiny, so the child can exit before it is read
+        process.join(MEASURE_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            print(f"{row} measurement timed out after {MEASURE_TIMEOUT}s")
+            failures += 1
+            continue
+        if process.exitcode != 0 or queue.empty():
+            print(f"{row} measurement failed (exit code {process.exitcode})")
+            failures += 1
+            continue
+        measured = queue.get()
+
+        error = (estimated - measured) / measured
+        margin_error = (with_margin - measured) / measured
+        errors.append(error)
+        # The raw estimate has to be close; with the margin it must not be low
+        failures += abs(error) > args.tolerance or margin_error < 0
+        print(f"{row} {estimated / 2**20:>8.1f}MB {measured / 2**20:>8.1f}MB {error:>+7.1%} {margin_error:>+8.1%}")
+
+    if errors:
+        print(f"\nMean error {sum(errors) / len(errors):+.1%}, worst underestimate {min(errors):+.1%}; "
+              f"plan adds a {DYNAMIC_MEMORY_MARGIN:.0%} margin on activations and logits")
+    if failures:
+        print(f"{failures} run(s) failed, off by more than {args.tolerance:.0%} or still low with the margin")
+        return 1
+    print(f"All estimates within {args.tolerance:.0%} of measured peaks and not low with the margin")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="Estimate memory and recommend a training setup")
+    plan_parser.add_argument("--model", help="Hub id, model directory or config.json (default: base_model_config.json)")
+    plan_parser.add_argument("--adapter-dir", default=REPO_DIR, help="Directory with adapter_config.json")
+    plan_parser.add_argument("--training-args", default=os.path.join(REPO_DIR, "training_args.bin"),
+                             help="Pickled TrainingArguments/SFTConfig ('' to skip)")
+    plan_parser.add_argument("--dataset", default=os.path.join(REPO_DIR, "rwtrainingdata.json"))
+    plan_parser.add_argument("--tokenizer", help="Tokenizer for exact lengths (default: the adapter base model, "
+                                                 "if it is in the local Hub cache)")
+    plan_parser.add_argument("--chars-per-token", type=float, default=4.0,
+                             help="Length approximation when no tokenizer is available")
+    budget = plan_parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--gpu", choices=sorted(GPU_PRESETS))
+    budget.add_argument("--budget-gb", type=float, help="Memory budget in GiB")
+    plan_parser.add_argument("--tflops", type=float, default=65, help="Peak TFLOPS for --budget-gb")
+    plan_parser.add_argument("--mfu", type=float, default=0.3, help="Assumed model FLOPs utilisation")
+    plan_parser.add_argument("--micro-batch", type=int)
+    plan_parser.add_argument("--grad-accum", type=int)
+    plan_parser.add_argument("--optim", choices=sorted(OPTIMIZER_STATE_BYTES))
+    plan_parser.add_argument("--max-length", type=int)
+    plan_parser.add_argument("--no-4bit", action="store_true", help="Plain LoRA instead of QLoRA")
+    plan_parser.add_argument("--double-quant", action="store_true", help="bnb_4bit_use_double_quant=True")
+    plan_parser.add_argument("--weights-dtype", choices=sorted(DTYPE_BYTES),
+                             help="dtype of non-quantized weights (default float32 with 4-bit, "
+                                  "since prepare_model_for_kbit_training upcasts them)")
+    plan_parser.add_argument("--compute-dtype", choices=sorted(DTYPE_BYTES))
+    plan_parser.add_argument("--attn-implementation", default="sdpa", choices=["eager", "sdpa", "flash_attention_2"])
+    plan_parser.add_argument("--overhead-gb", type=float, default=0.5, help="CUDA context and allocator slack")
+    plan_parser.add_argument("--margin", type=float, default=DYNAMIC_MEMORY_MARGIN,
+                             help="Safety margin as a fraction of activations and logits")
+
+    validate_parser = subparsers.add_parser("validate", help="Compare estimates with measured CPU peaks")
+    validate_parser.add_argument("--adapter-dir", default=REPO_DIR)
+    validate_parser.add_argument("--tolerance", type=float, default=0.15)
+
+    args = parser.parse_args(argv)
+    if args.command == "plan":
+        return run_plan(args)
+    if args.command == "validate":
+        return run_validate(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())